@@ -1,41 +1,219 @@
 # db.py - Improved version with security, error handling, and context managers
 import sqlite3
 import os
+import io
+import csv
 import json
+import math
 import pandas as pd
+import numpy as np
 import logging
+import time
+import threading
+import queue
+import atexit
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from contextlib import contextmanager
+from contextlib import contextmanager, closing
 from werkzeug.security import generate_password_hash, check_password_hash
 
+# orjson is much faster for the per-row response blobs; stdlib json as fallback.
+# Text (not bytes) is stored so SQLite's JSON functions keep working on the column.
+try:
+    import orjson
+
+    _ORJSON_OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def _has_non_finite(obj):
+        """True if a NaN/Infinity float is nested anywhere in obj."""
+        if isinstance(obj, float):
+            return not math.isfinite(obj)
+        if isinstance(obj, dict):
+            return any(_has_non_finite(v) for v in obj.values())
+        if isinstance(obj, (list, tuple)):
+            return any(_has_non_finite(v) for v in obj)
+        return False
+
+    def _json_dumps(obj):
+        # orjson writes NaN as null; keep the NaN token stdlib json has always stored
+        if _has_non_finite(obj):
+            return json.dumps(obj)
+        try:
+            return orjson.dumps(obj, option=_ORJSON_OPTS).decode()
+        except TypeError:
+            # Types orjson rejects (e.g. Decimal, int subclasses as keys)
+            return json.dumps(obj)
+
+    def _json_loads(text):
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # NaN/Infinity tokens written by stdlib json
+            return json.loads(text)
+except ImportError:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
+# PyArrow's C++ CSV writer is used for exports when installed
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DB_PATH = "data/users.db"
 
+# ============ HOT-PATH SQL ============
+# sqlite3 caches prepared statements per connection keyed by SQL text; keeping the
+# hottest statements in one place guarantees every caller hits the same cache entry.
+_SQL_AUTH = "SELECT id, password FROM users WHERE username=?"
+_SQL_TOUCH_LAST_LOGIN = "UPDATE users SET last_login=CURRENT_TIMESTAMP WHERE id=?"
+_SQL_INSERT_SENSOR = """
+    INSERT INTO sensors_data (user_id, source_filename, bpm, hrv) 
+    VALUES (?, ?, ?, ?)
+"""
+_SQL_SENSOR_HISTORY = """
+    SELECT id, source_filename, bpm, hrv, timestamp 
+    FROM sensors_data 
+    WHERE user_id=? 
+    ORDER BY timestamp
+"""
+_SQL_SENSOR_HISTORY_SINCE = """
+    SELECT id, source_filename, bpm, hrv, timestamp 
+    FROM sensors_data 
+    WHERE user_id=? AND timestamp>=? 
+    ORDER BY timestamp
+"""
+
 # ============ CONTEXT MANAGER FOR DATABASE ============
+def _sql_float(value):
+    """Python's float() as a SQL function, so SQLite parses legacy response values the same way."""
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+def _register_functions(conn):
+    """Add the Python helpers used inside SQL to a connection."""
+    conn.create_function("py_float", 1, _sql_float, deterministic=True)
+
+
+# One long-lived connection per thread instead of a connect/close per query
+_local = threading.local()
+# thread -> pooled connection, so they can all be closed when the worker exits
+_pool = {}
+_pool_lock = threading.Lock()
+
+def _conn():
+    """Return this thread's connection, opening and tuning it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+        # Per-connection settings; journal_mode=WAL is persistent and set in init_db
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-64000")
+        _register_functions(conn)
+        _local.conn = conn
+        with _pool_lock:
+            # Threads that have finished will never use their connection again
+            for thread in [t for t in _pool if not t.is_alive()]:
+                _pool.pop(thread).close()
+            _pool[threading.current_thread()] = conn
+    return conn
+
+# Connections inherited through fork() (gunicorn workers, Dash background callbacks)
+# belong to the parent: SQLite forbids using or closing them in the child, so the
+# child only keeps them referenced and opens its own.
+_inherited_conns = []
+
+def _reset_pool_after_fork():
+    """Give a forked child an empty pool."""
+    global _local, _pool_lock
+    _inherited_conns.extend(_pool.values())
+    _pool.clear()
+    _local = threading.local()
+    _pool_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+@atexit.register
+def _close_pool():
+    """Close the pooled connections of every thread (checkpoints the WAL)."""
+    with _pool_lock:
+        while _pool:
+            try:
+                _pool.popitem()[1].close()
+            except sqlite3.Error as e:
+                logger.warning(f"Error closing pooled connection: {e}")
+
 @contextmanager
-def get_db_connection():
-    """Context manager for database connections with automatic cleanup."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+def get_db_connection(row_factory=None):
+    """
+    Context manager yielding the thread's connection; rolls back on error.
+    Rows are plain tuples unless a row_factory (e.g. sqlite3.Row) is given.
+    """
+    conn = _conn()
+    conn.row_factory = row_factory
     try:
         yield conn
     except Exception as e:
         logger.error(f"Database error: {e}", exc_info=True)
         conn.rollback()
         raise
-    finally:
-        conn.close()
+
+# ============ IN-PROCESS CACHE ============
+# (user_id, questionnaire_id) -> (questionnaire revision, parsed rows), least recently used first
+_Q_CACHE = OrderedDict()
+_Q_CACHE_MAX = 256
+_Q_CACHE_LOCK = threading.Lock()
+
+# user_id -> (expiry, profile dict); profiles are read on many callbacks but rarely change
+_USER_CACHE = {}
+_USER_CACHE_TTL = 60
+_USER_CACHE_MAX = 1024
+
+def get_user_revision(user_id):
+    """
+    Revision of the user's stored questionnaires and sensor readings, read from the
+    database so every process agrees on it; use it in cache keys for derived data
+    such as figures (e.g. in a Flask-Caching FileSystemCache shared by the workers).
+    """
+    try:
+        flush_sensor_writes()
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT (SELECT IFNULL(MAX(id), 0) || ':' || COUNT(*) 
+                        FROM questionnaires WHERE user_id=?),
+                       (SELECT IFNULL(MAX(id), 0) || ':' || COUNT(*) 
+                        FROM sensors_data WHERE user_id=?)
+            """, (user_id, user_id))
+            return "q{}-s{}".format(*c.fetchone())
+
+    except Exception as e:
+        logger.error(f"Error getting data revision for user {user_id}: {e}", exc_info=True)
+        return None
 
 # ============ INITIALIZATION ============
 def init_db():
     """Initialize database tables if they don't exist."""
     try:
         os.makedirs("data", exist_ok=True)
-        with get_db_connection() as conn:
+        with closing(sqlite3.connect(DB_PATH)) as conn:
             c = conn.cursor()
+
+            # WAL se guarda en la cabecera del fichero: basta con activarlo una vez
+            if DB_PATH != ":memory:":
+                c.execute("PRAGMA journal_mode=WAL")
             
             # Tabla usuarios
             c.execute("""
@@ -74,6 +252,64 @@ def init_db():
                 FOREIGN KEY(user_id) REFERENCES users(id)
             )"""
             )
+
+            # Tabla de sesiones de entrenamiento: carga (RPE × duración) de cada
+            # cuestionario "general" en columnas, para no usar json_extract en el ACWR
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS training_sessions (
+                questionnaire_row_id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                timestamp DATETIME NOT NULL,
+                rpe REAL NOT NULL,
+                duracion REAL NOT NULL,
+                load REAL NOT NULL,
+                FOREIGN KEY(questionnaire_row_id) REFERENCES questionnaires(id)
+            )"""
+            )
+
+            # Migrar los cuestionarios que aún no tengan sesión, con el mismo
+            # cálculo que save_questionnaire para que el ACWR no cambie
+            c.execute("""
+            SELECT id, user_id, timestamp, responses 
+            FROM questionnaires 
+            WHERE questionnaire_id='general' 
+              AND id > (SELECT IFNULL(MAX(questionnaire_row_id), 0) FROM training_sessions)"""
+            )
+            sessions = []
+            for row_id, user_id, timestamp, responses in c.fetchall():
+                try:
+                    responses = _json_loads(responses)
+                except ValueError:
+                    continue
+                if not isinstance(responses, dict):
+                    continue
+                load = compute_session_load_from_responses(responses)
+                if load is not None:
+                    sessions.append((row_id, user_id, timestamp,
+                                     float(responses["rpe"]), float(responses["duracion"]), load))
+            c.executemany("""
+            INSERT OR IGNORE INTO training_sessions 
+                (questionnaire_row_id, user_id, timestamp, rpe, duracion, load)
+            VALUES (?, ?, ?, ?, ?, ?)""", sessions
+            )
+
+            # Índices para las consultas de historial por usuario
+            c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_q_user_qid_ts
+            ON questionnaires(user_id, questionnaire_id, timestamp)"""
+            )
+            c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_q_user_ts
+            ON questionnaires(user_id, timestamp)"""
+            )
+            c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_s_user_ts
+            ON sensors_data(user_id, timestamp)"""
+            )
+            c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_ts_user_ts
+            ON training_sessions(user_id, timestamp, load)"""
+            )
             
             conn.commit()
             logger.info("Database initialized successfully")
@@ -88,6 +324,9 @@ def hash_password(password):
         raise ValueError("Password must be at least 6 characters long")
     return generate_password_hash(password)
 
+# Hash checked when the username does not exist, so a miss costs the same as a wrong password
+_DUMMY_PASSWORD_HASH = generate_password_hash("dummy-password-for-timing")
+
 def verify_password(password, hashed):
     """Verify a password against its hash."""
     try:
@@ -129,17 +368,17 @@ def authenticate_user(username, password):
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute("""
-                SELECT id, password FROM users WHERE username=?
-            """, (username,))
+            c.execute(_SQL_AUTH, (username,))
             row = c.fetchone()
             
-            if row and verify_password(password, row['password']):
-                user_id = row['id']
-                # Update last_login
-                c.execute("UPDATE users SET last_login=? WHERE id=?", 
-                         (datetime.now(), user_id))
+            if row is None:
+                verify_password(password, _DUMMY_PASSWORD_HASH)
+            elif verify_password(password, row[1]):
+                user_id = row[0]
+                # Update last_login (timestamp computed by SQLite, like created_at)
+                c.execute(_SQL_TOUCH_LAST_LOGIN, (user_id,))
                 conn.commit()
+                _USER_CACHE.pop(user_id, None)
                 logger.info(f"User authenticated: {username}")
                 return user_id
             
@@ -151,32 +390,61 @@ def authenticate_user(username, password):
         return None
 
 def get_user_by_id(user_id):
-    """Get user information by ID."""
+    """Get user information by ID (cached for a short TTL)."""
     try:
-        with get_db_connection() as conn:
+        now = time.monotonic()
+        cached = _USER_CACHE.get(user_id)
+        if cached and cached[0] > now:
+            return dict(cached[1])
+
+        with get_db_connection(sqlite3.Row) as conn:
             c = conn.cursor()
             c.execute("""
                 SELECT id, username, edad, deporte, created_at, last_login 
                 FROM users WHERE id=?
             """, (user_id,))
             row = c.fetchone()
-            return dict(row) if row else None
+            if row is None:
+                return None
+
+            user = dict(row)
+            if len(_USER_CACHE) >= _USER_CACHE_MAX:
+                # Drop the oldest entry
+                _USER_CACHE.pop(next(iter(_USER_CACHE)), None)
+            _USER_CACHE[user_id] = (now + _USER_CACHE_TTL, user)
+            return dict(user)
             
     except Exception as e:
         logger.error(f"Error getting user {user_id}: {e}", exc_info=True)
         return None
 
 # ============ QUESTIONNAIRES - VALIDATION ============
+# qid -> (definition it was built from, [(key, min, max), ...])
+_COMPILED_FIELDS = {}
+
+def _compiled_fields(questionnaire_id, q_def):
+    """Field bounds as float tuples, built once per questionnaire definition."""
+    cached = _COMPILED_FIELDS.get(questionnaire_id)
+    if cached is None or cached[0] is not q_def:
+        fields = [
+            (field["key"],
+             float(field.get("min", float('-inf'))),
+             float(field.get("max", float('inf'))))
+            for field in q_def.get("fields", [])
+        ]
+        cached = (q_def, fields)
+        _COMPILED_FIELDS[questionnaire_id] = cached
+    return cached[1]
+
 def validate_questionnaire_response(questionnaire_id, responses, questionnaire_defs):
     """Validate questionnaire responses against defined fields."""
     try:
         if questionnaire_id not in questionnaire_defs:
             return False, f"Unknown questionnaire: {questionnaire_id}"
         
-        q_def = questionnaire_defs[questionnaire_id]
+        fields = _compiled_fields(questionnaire_id, questionnaire_defs[questionnaire_id])
         
-        for field in q_def.get("fields", []):
-            key = field["key"]
+        for key, min_val, max_val in fields:
             value = responses.get(key)
             
             # Check if required field is present
@@ -186,13 +454,11 @@ def validate_questionnaire_response(questionnaire_id, responses, questionnaire_d
             # Validate field type and range
             try:
                 val_num = float(value)
-                min_val = float(field.get("min", float('-inf')))
-                max_val = float(field.get("max", float('inf')))
-                
-                if not (min_val <= val_num <= max_val):
-                    return False, f"Field '{key}' out of range [{min_val}, {max_val}]"
             except (ValueError, TypeError):
                 return False, f"Field '{key}' must be numeric"
+
+            if not (min_val <= val_num <= max_val):
+                return False, f"Field '{key}' out of range [{min_val}, {max_val}]"
         
         return True, "Valid"
         
@@ -200,15 +466,62 @@ def validate_questionnaire_response(questionnaire_id, responses, questionnaire_d
         logger.error(f"Error validating questionnaire {questionnaire_id}: {e}")
         return False, "Validation error"
 
+# Every questionnaire field is numeric (sliders and number inputs in
+# questionnaires.QUESTIONNAIRES), so each response is coerced once when saving;
+# new fields are picked up without touching this module.
+def _numeric_responses(responses):
+    """Coerce every response field to float (None when not parseable)."""
+    numeric = {}
+    for key, value in responses.items():
+        if key == "_numeric":
+            continue
+        try:
+            numeric[key] = float(value)
+        except (ValueError, TypeError):
+            numeric[key] = None
+    return numeric
+
+def _questionnaire_row(r):
+    """
+    Build the questionnaire dict from an (id, questionnaire_id, responses, timestamp) row.
+    The stored '_numeric' sub-dict is returned as 'numeric', next to the untouched responses.
+    """
+    row_id, questionnaire_id, responses, timestamp = r
+    responses = _json_loads(responses)
+    numeric = responses.pop("_numeric", None)
+    if numeric is None:
+        # Rows stored before the numeric sub-dict existed
+        numeric = _numeric_responses(responses)
+    return {
+        "id": row_id,
+        "questionnaire_id": questionnaire_id,
+        "responses": responses,
+        "numeric": numeric,
+        "timestamp": timestamp
+    }
+
 def save_questionnaire(user_id, questionnaire_id, responses):
     """Save questionnaire responses to database."""
     try:
+        stored = dict(responses, _numeric=_numeric_responses(responses))
         with get_db_connection() as conn:
             c = conn.cursor()
             c.execute("""
                 INSERT INTO questionnaires (user_id, questionnaire_id, responses) 
                 VALUES (?, ?, ?)
-            """, (user_id, questionnaire_id, json.dumps(responses)))
+            """, (user_id, questionnaire_id, _json_dumps(stored)))
+
+            if questionnaire_id == "general":
+                load = compute_session_load_from_responses(responses)
+                if load is not None:
+                    # Same transaction and timestamp as the questionnaire row
+                    c.execute("""
+                        INSERT INTO training_sessions 
+                            (questionnaire_row_id, user_id, timestamp, rpe, duracion, load)
+                        SELECT id, user_id, timestamp, ?, ?, ? 
+                        FROM questionnaires WHERE id=?
+                    """, (stored["_numeric"]["rpe"], stored["_numeric"]["duracion"],
+                          load, c.lastrowid))
             conn.commit()
             logger.info(f"Questionnaire saved for user {user_id}: {questionnaire_id}")
             return True
@@ -217,118 +530,321 @@ def save_questionnaire(user_id, questionnaire_id, responses):
         logger.error(f"Error saving questionnaire for user {user_id}: {e}", exc_info=True)
         return False
 
+def _fetch_questionnaire_history(user_id, questionnaire_id=None):
+    """Read and parse the full questionnaire history from the database."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+
+        if questionnaire_id:
+            c.execute("""
+                SELECT id, questionnaire_id, responses, timestamp 
+                FROM questionnaires 
+                WHERE user_id=? AND questionnaire_id=? 
+                ORDER BY timestamp
+            """, (user_id, questionnaire_id))
+
+        else:
+            c.execute("""
+                SELECT id, questionnaire_id, responses, timestamp 
+                FROM questionnaires 
+                WHERE user_id=? 
+                ORDER BY timestamp, id
+            """, (user_id,))
+
+        return [_questionnaire_row(r) for r in c.fetchall()]
+
+def _questionnaire_revision(user_id):
+    """
+    State of the user's questionnaire rows as stored in the database, so writes
+    from other processes (workers, background callbacks) invalidate the cache too.
+    """
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT IFNULL(MAX(id), 0), COUNT(*) 
+            FROM questionnaires 
+            WHERE user_id=?
+        """, (user_id,))
+        return c.fetchone()
+
 def get_questionnaire_history(user_id, questionnaire_id=None, days=None):
-    """Get questionnaire history with optional filtering."""
+    """
+    Get questionnaire history with optional filtering (cached until the user's rows change).
+    The row dicts are shared with the cache: treat them as read-only and copy before editing.
+    """
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            
-            if questionnaire_id and days:
-                since = datetime.now() - timedelta(days=days)
-                c.execute("""
-                    SELECT id, questionnaire_id, responses, timestamp 
-                    FROM questionnaires 
-                    WHERE user_id=? AND questionnaire_id=? AND timestamp>=? 
-                    ORDER BY timestamp
-                """, (user_id, questionnaire_id, since))
-                
-            elif questionnaire_id:
-                c.execute("""
-                    SELECT id, questionnaire_id, responses, timestamp 
-                    FROM questionnaires 
-                    WHERE user_id=? AND questionnaire_id=? 
-                    ORDER BY timestamp
-                """, (user_id, questionnaire_id))
-                
-            else:
-                c.execute("""
-                    SELECT id, questionnaire_id, responses, timestamp 
-                    FROM questionnaires 
-                    WHERE user_id=? 
-                    ORDER BY timestamp
-                """, (user_id,))
-            
-            rows = c.fetchall()
-            result = []
-            for r in rows:
-                result.append({
-                    "id": r['id'],
-                    "questionnaire_id": r['questionnaire_id'],
-                    "responses": json.loads(r['responses']),
-                    "timestamp": r['timestamp']
-                })
-            return result
+        rev = _questionnaire_revision(user_id)
+        key = (user_id, questionnaire_id)
+        with _Q_CACHE_LOCK:
+            cached = _Q_CACHE.get(key)
+            if cached is not None and cached[0] == rev:
+                _Q_CACHE.move_to_end(key)
+        if cached is None or cached[0] != rev:
+            cached = (rev, _fetch_questionnaire_history(user_id, questionnaire_id))
+            with _Q_CACHE_LOCK:
+                _Q_CACHE[key] = cached
+                _Q_CACHE.move_to_end(key)
+                if len(_Q_CACHE) > _Q_CACHE_MAX:
+                    _Q_CACHE.popitem(last=False)
+
+        rows = cached[1]
+        if days:
+            # Same text comparison SQLite would do against the adapted datetime
+            since = (datetime.now() - timedelta(days=days)).isoformat(" ")
+            return [r for r in rows if r["timestamp"] >= since]
+        return list(rows)
             
     except Exception as e:
         logger.error(f"Error getting questionnaire history for user {user_id}: {e}", exc_info=True)
         return []
 
+def iter_questionnaire_history(user_id, questionnaire_id=None, days=None):
+    """
+    Yield questionnaire rows one at a time straight from the cursor (uncached).
+    For reductions that don't need the whole history in memory; use
+    get_questionnaire_history when random access is needed.
+    """
+    query = """
+        SELECT id, questionnaire_id, responses, timestamp 
+        FROM questionnaires 
+        WHERE user_id=?
+    """
+    params = [user_id]
+    if questionnaire_id:
+        query += " AND questionnaire_id=?"
+        params.append(questionnaire_id)
+    if days:
+        query += " AND timestamp>=?"
+        params.append(datetime.now() - timedelta(days=days))
+    query += " ORDER BY timestamp, id"
+
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute(query, params)
+            for r in c:
+                yield _questionnaire_row(r)
+
+    except Exception as e:
+        logger.error(f"Error iterating questionnaire history for user {user_id}: {e}", exc_info=True)
+
+def get_questionnaires_in(user_id, ids, days=None):
+    """Get the history of several questionnaires at once, filtered by SQLite."""
+    try:
+        ids = list(ids)
+        if not ids:
+            return []
+
+        query = """
+            SELECT id, questionnaire_id, responses, timestamp 
+            FROM questionnaires 
+            WHERE user_id=? AND questionnaire_id IN (%s)
+        """ % ",".join("?" * len(ids))
+        params = [user_id] + ids
+        if days:
+            query += " AND timestamp>=?"
+            params.append(datetime.now() - timedelta(days=days))
+        query += " ORDER BY timestamp, id"
+
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute(query, params)
+            return [_questionnaire_row(r) for r in c.fetchall()]
+
+    except Exception as e:
+        logger.error(f"Error getting questionnaires {ids} for user {user_id}: {e}", exc_info=True)
+        return []
+
+def get_latest_questionnaire(user_id, questionnaire_id):
+    """Get the most recent entry of a questionnaire, or None."""
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT id, questionnaire_id, responses, timestamp 
+                FROM questionnaires 
+                WHERE user_id=? AND questionnaire_id=? 
+                ORDER BY timestamp DESC, id DESC 
+                LIMIT 1
+            """, (user_id, questionnaire_id))
+            r = c.fetchone()
+            return _questionnaire_row(r) if r else None
+
+    except Exception as e:
+        logger.error(f"Error getting latest questionnaire for user {user_id}: {e}", exc_info=True)
+        return None
+
 # ============ SENSORS ============
+def _clean_sensor_values(bpm, hrv):
+    """Coerce BPM/HRV to float and warn about implausible values."""
+    if bpm is not None:
+        bpm = float(bpm)
+        if not (30 <= bpm <= 200):
+            logger.warning(f"BPM out of normal range: {bpm}")
+    
+    if hrv is not None:
+        hrv = float(hrv)
+        if hrv < 0:
+            logger.warning(f"HRV negative: {hrv}")
+
+    return bpm, hrv
+
+# Single readings are queued and committed in batches by a background writer,
+# so callbacks never wait on the commit.
+_write_q = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+_WRITE_BATCH_MAX = 500
+_WRITE_BATCH_WAIT = 0.05  # seconds
+
+def _write_sensor_batch(batch):
+    """Insert a batch of (user_id, source_filename, bpm, hrv) rows in one transaction."""
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.executemany(_SQL_INSERT_SENSOR, batch)
+            conn.commit()
+        logger.info(f"Sensor writer committed {len(batch)} rows")
+    except Exception as e:
+        logger.error(f"Error writing sensor batch of {len(batch)} rows: {e}", exc_info=True)
+
+def _sensor_writer():
+    """Drain the write queue: up to _WRITE_BATCH_MAX rows or _WRITE_BATCH_WAIT per commit."""
+    while True:
+        batch, flushed = [], None
+        item = _write_q.get()
+        deadline = time.monotonic() + _WRITE_BATCH_WAIT
+        while True:
+            if isinstance(item, threading.Event):
+                # Flush marker: commit the rows queued before it right away
+                flushed = item
+                break
+            batch.append(item)
+            remaining = deadline - time.monotonic()
+            if len(batch) >= _WRITE_BATCH_MAX or remaining <= 0:
+                break
+            try:
+                item = _write_q.get(timeout=remaining)
+            except queue.Empty:
+                break
+        if batch:
+            _write_sensor_batch(batch)
+        if flushed is not None:
+            flushed.set()
+
+def _ensure_sensor_writer():
+    """Start the background writer on first use."""
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_sensor_writer, name="sensor-writer", daemon=True)
+            _writer_thread.start()
+
+def _reset_sensor_writer_after_fork():
+    """The writer thread doesn't exist in a forked child; start from an empty queue."""
+    global _write_q, _writer_thread, _writer_lock
+    _write_q = queue.Queue()
+    _writer_thread = None
+    _writer_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_sensor_writer_after_fork)
+
+@atexit.register
+def flush_sensor_writes():
+    """Block until the sensor readings queued before this call have been committed."""
+    if _writer_thread is not None:
+        # Only waits for its own place in the queue, not for rows other users add meanwhile
+        done = threading.Event()
+        _write_q.put(done)
+        done.wait()
+
 def save_sensor_data(user_id, source_filename, bpm, hrv):
-    """Save sensor data to database."""
+    """
+    Validate and queue sensor data; the background writer commits it shortly after.
+    Returns True once the reading is queued, before the commit: a failed write is
+    only logged. Callers that need the rows durably saved (or the error) should use
+    save_sensor_data_many, which commits synchronously.
+    """
     try:
         # Validate sensor values
-        if bpm is not None:
-            bpm = float(bpm)
-            if not (30 <= bpm <= 200):
-                logger.warning(f"BPM out of normal range: {bpm}")
-        
-        if hrv is not None:
-            hrv = float(hrv)
-            if hrv < 0:
-                logger.warning(f"HRV negative: {hrv}")
-        
+        bpm, hrv = _clean_sensor_values(bpm, hrv)
+
+        _ensure_sensor_writer()
+        _write_q.put((user_id, source_filename, bpm, hrv))
+        logger.info(f"Sensor data queued for user {user_id}: BPM={bpm}, HRV={hrv}")
+        return True
+            
+    except Exception as e:
+        logger.error(f"Error saving sensor data for user {user_id}: {e}", exc_info=True)
+        return False
+
+def save_sensor_data_many(user_id, rows):
+    """
+    Save several sensor readings in a single transaction.
+    rows: iterable of (source_filename, bpm, hrv) tuples, e.g. one per uploaded file.
+    """
+    try:
+        rows = list(rows)
+        if not rows:
+            return True
+
+        # Readings queued earlier by save_sensor_data go in first, keeping call order
+        flush_sensor_writes()
+
+        # Validate the whole batch in one vectorized pass (None -> NaN)
+        values = np.array([(bpm, hrv) for _, bpm, hrv in rows], dtype=float).reshape(-1, 2)
+        bpm, hrv = values[:, 0], values[:, 1]
+        n_bpm_out = int(np.count_nonzero((bpm < 30) | (bpm > 200)))
+        n_hrv_neg = int(np.count_nonzero(hrv < 0))
+        if n_bpm_out:
+            logger.warning(f"BPM out of normal range in {n_bpm_out} rows")
+        if n_hrv_neg:
+            logger.warning(f"HRV negative in {n_hrv_neg} rows")
+
+        clean = np.where(np.isnan(values), None, values).tolist()
+        params = [(user_id, name, b, h) for (name, _, _), (b, h) in zip(rows, clean)]
+
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute("""
-                INSERT INTO sensors_data (user_id, source_filename, bpm, hrv) 
-                VALUES (?, ?, ?, ?)
-            """, (user_id, source_filename, bpm, hrv))
+            c.executemany(_SQL_INSERT_SENSOR, params)
             conn.commit()
-            logger.info(f"Sensor data saved for user {user_id}: BPM={bpm}, HRV={hrv}")
+            logger.info(f"Sensor data saved for user {user_id}: {len(params)} rows")
             return True
-            
+
     except Exception as e:
         logger.error(f"Error saving sensor data for user {user_id}: {e}", exc_info=True)
         return False
 
-def get_sensor_history(user_id, days=None):
-    """Get sensor history data."""
+def get_sensor_history(user_id, days=None, as_frame=False):
+    """
+    Get sensor history data.
+    With as_frame=True the rows are read straight into a DataFrame by pandas
+    (timestamp parsed as datetime) instead of a list of dicts.
+    """
     try:
+        # Readers see every reading saved before the call
+        flush_sensor_writes()
+
+        if days:
+            query = _SQL_SENSOR_HISTORY_SINCE
+            params = (user_id, datetime.now() - timedelta(days=days))
+        else:
+            query = _SQL_SENSOR_HISTORY
+            params = (user_id,)
+
         with get_db_connection() as conn:
+            if as_frame:
+                return pd.read_sql_query(query, conn, params=params, parse_dates=["timestamp"])
+
             c = conn.cursor()
-            
-            if days:
-                since = datetime.now() - timedelta(days=days)
-                c.execute("""
-                    SELECT id, source_filename, bpm, hrv, timestamp 
-                    FROM sensors_data 
-                    WHERE user_id=? AND timestamp>=? 
-                    ORDER BY timestamp
-                """, (user_id, since))
-            else:
-                c.execute("""
-                    SELECT id, source_filename, bpm, hrv, timestamp 
-                    FROM sensors_data 
-                    WHERE user_id=? 
-                    ORDER BY timestamp
-                """, (user_id,))
-            
-            rows = c.fetchall()
-            result = []
-            for r in rows:
-                result.append({
-                    "id": r['id'],
-                    "source_filename": r['source_filename'],
-                    "bpm": r['bpm'],
-                    "hrv": r['hrv'],
-                    "timestamp": r['timestamp']
-                })
-            return result
+            c.execute(query, params)
+            columns = [d[0] for d in c.description]
+            return [dict(zip(columns, r)) for r in c.fetchall()]
             
     except Exception as e:
         logger.error(f"Error getting sensor history for user {user_id}: {e}", exc_info=True)
-        return []
+        return pd.DataFrame() if as_frame else []
 
 # ============ TRAINING LOAD & ACWR ============
 def compute_session_load_from_responses(responses):
@@ -357,45 +873,76 @@ def compute_session_load_from_responses(responses):
         logger.error(f"Error computing session load: {e}")
         return None
 
-def get_training_load_history(user_id, days=None):
-    """Get training load history."""
+def _json_number_sql(key):
+    """
+    SQL expression for a numeric response field, NULL when it isn't a number.
+    Uses the float() value stored in _numeric; legacy rows go through py_float so
+    "5" counts as 5.0 while "" or "n/a" stay NULL (a bare CAST would give 0.0).
+    """
+    return f"""COALESCE(
+               json_extract(responses, '$._numeric.{key}'),
+               py_float(json_extract(responses, '$.{key}')))"""
+
+# Per-session load (RPE × duration) computed inside SQLite. The load is NULL
+# wherever compute_session_load_from_responses would reject the values.
+_SESSION_LOAD_SQL = f"""
+    SELECT timestamp,
+           CASE WHEN rpe BETWEEN 0 AND 10 AND duracion>=0 THEN rpe * duracion END AS load
+    FROM (
+        SELECT timestamp,
+               {_json_number_sql("rpe")} AS rpe,
+               {_json_number_sql("duracion")} AS duracion
+        FROM questionnaires
+        WHERE user_id=? AND questionnaire_id='general' AND timestamp>=?
+          AND json_valid(responses)
+    )
+"""
+
+def get_training_load_history_fast(user_id, days=None):
+    """Get training load history with the load extracted by SQLite (no JSON parsing in Python)."""
     try:
-        history = get_questionnaire_history(user_id, questionnaire_id="general", days=days)
-        loads = []
-        
-        for h in history:
-            load = compute_session_load_from_responses(h["responses"])
-            loads.append({"timestamp": h["timestamp"], "load": load})
-        
-        return loads
-        
+        since = datetime.now() - timedelta(days=days) if days else datetime.min
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute(_SESSION_LOAD_SQL + " ORDER BY timestamp", (user_id, since))
+            return [{"timestamp": ts, "load": load} for ts, load in c.fetchall()]
+
     except Exception as e:
         logger.error(f"Error getting training load history for user {user_id}: {e}")
         return []
 
+def get_training_load_history(user_id, days=None):
+    """Get training load history."""
+    return get_training_load_history_fast(user_id, days=days)
+
 def compute_acwr(user_id, acute_days=7, chronic_days=28):
     """
     Compute Acute:Chronic Workload Ratio (ACWR).
     ACWR = mean(acute window) / mean(chronic window)
     """
     try:
-        acute = get_training_load_history(user_id, days=acute_days)
-        chronic = get_training_load_history(user_id, days=chronic_days)
+        now = datetime.now()
+        acute_since = now - timedelta(days=acute_days)
+        chronic_since = now - timedelta(days=chronic_days)
 
-        acute_vals = [d["load"] for d in acute if d["load"] is not None]
-        chronic_vals = [d["load"] for d in chronic if d["load"] is not None]
+        # Both windowed means in one indexed range scan over the normalized loads
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT AVG(CASE WHEN timestamp>=? THEN load END) AS acute_mean,
+                       AVG(load) AS chronic_mean
+                FROM training_sessions 
+                WHERE user_id=? AND timestamp>=?
+            """, (acute_since, user_id, chronic_since))
+            acute_mean, chronic_mean = c.fetchone()
 
-        if not acute_vals:
+        if acute_mean is None:
             logger.info(f"No acute data for user {user_id}")
             return None
-        
-        acute_mean = sum(acute_vals) / len(acute_vals)
 
-        if not chronic_vals:
+        if chronic_mean is None:
             logger.info(f"No chronic data for user {user_id}")
             return None
-        
-        chronic_mean = sum(chronic_vals) / len(chronic_vals)
 
         if chronic_mean == 0:
             logger.warning(f"Zero chronic mean for user {user_id}")
@@ -414,6 +961,23 @@ def compute_acwr(user_id, acute_days=7, chronic_days=28):
         logger.error(f"Error computing ACWR for user {user_id}: {e}")
         return None
 
+def compute_correlation(x, y):
+    """Pearson r between two series, ignoring pairs with missing values; None if undefined."""
+    try:
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        mask = ~(np.isnan(x) | np.isnan(y))
+        x, y = x[mask], y[mask]
+
+        if len(x) < 2 or np.ptp(x) == 0 or np.ptp(y) == 0:
+            return None
+
+        return float(np.corrcoef(x, y)[0, 1])
+
+    except (ValueError, TypeError) as e:
+        logger.error(f"Error computing correlation: {e}")
+        return None
+
 # ============ EXPORT ============
 def export_user_data_csv(user_id, output_filepath=None):
     """Export user data (questionnaires + sensors) to CSV."""
@@ -423,44 +987,121 @@ def export_user_data_csv(user_id, output_filepath=None):
             output_filepath = f"data/export_user_{user_id}_{ts}.csv"
 
         q = get_questionnaire_history(user_id)
-        s = get_sensor_history(user_id)
+        s_df = get_sensor_history(user_id, as_frame=True)
 
-        records = []
-        
-        # Add questionnaire records
-        for item in q:
-            base = {
+        # Build each frame in one pass instead of merging dicts row by row
+        q_df = pd.json_normalize([
+            {
                 "type": "questionnaire",
                 "record_id": item["id"],
                 "questionnaire_id": item["questionnaire_id"],
-                "timestamp": item["timestamp"]
-            }
-            for k, v in item["responses"].items():
-                base[k] = v
-            records.append(base)
-
-        # Add sensor records
-        for item in s:
-            base = {
-                "type": "sensor",
-                "record_id": item["id"],
-                "source_filename": item["source_filename"],
-                "bpm": item["bpm"],
-                "hrv": item["hrv"],
-                "timestamp": item["timestamp"]
+                "timestamp": item["timestamp"],
+                **item["responses"]
             }
-            records.append(base)
+            for item in q
+        ])
+        s_df = s_df.rename(columns={"id": "record_id"})
+        s_df.insert(0, "type", "sensor")
 
-        # Create DataFrame and export
-        if len(records) == 0:
-            df = pd.DataFrame()
-        else:
-            df = pd.DataFrame.from_records(records)
+        frames = [f for f in (q_df, s_df) if not f.empty]
+        df = pd.concat(frames, ignore_index=True, sort=False) if frames else pd.DataFrame()
         
-        df.to_csv(output_filepath, index=False)
+        written = False
+        if PYARROW_AVAILABLE and not df.empty:
+            # Questionnaire timestamps are text, sensor ones datetimes: unify for Arrow
+            df["timestamp"] = df["timestamp"].astype(str)
+            try:
+                pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), output_filepath)
+                written = True
+            except pa.ArrowException as e:
+                # e.g. a response key holding numbers in some rows and text in others
+                logger.info(f"Arrow CSV writer failed ({e}), falling back to pandas")
+        if not written:
+            df.to_csv(output_filepath, index=False)
         logger.info(f"Data exported for user {user_id} to {output_filepath}")
         return output_filepath
         
     except Exception as e:
         logger.error(f"Error exporting data for user {user_id}: {e}", exc_info=True)
-        return None
\ No newline at end of file
+        return None
+
+def iter_user_data_csv(user_id, batch_size=500):
+    """
+    Stream the same columns and rows as export_user_data_csv, chunk by chunk, straight
+    from the DB cursors. Values are written by the csv module, so quoting and number
+    formatting can differ from the file export (e.g. 60 vs 60.0).
+    Meant to be wrapped in a Flask Response so large exports never sit in memory or on disk.
+    Rows with malformed JSON responses are skipped. Errors are logged and re-raised, so a
+    failed export aborts the response instead of ending as a truncated CSV.
+    """
+    try:
+        flush_sensor_writes()
+        with get_db_connection(sqlite3.Row) as conn:
+            c = conn.cursor()
+            # Response keys in first-seen order (by timestamp, id, then position in the
+            # document), as pandas lays out the columns; SQLite walks the JSON, Python dedups
+            c.execute("""
+                SELECT j.key 
+                FROM questionnaires AS q, json_each(q.responses) AS j 
+                WHERE q.user_id=? AND json_valid(q.responses) AND j.key != '_numeric' 
+                ORDER BY q.timestamp, q.id, j.id
+            """, (user_id,))
+            keys = list(dict.fromkeys(r[0] for r in c))
+            c.execute("""
+                SELECT EXISTS(SELECT 1 FROM questionnaires WHERE user_id=?),
+                       EXISTS(SELECT 1 FROM sensors_data WHERE user_id=?)
+            """, (user_id, user_id))
+            has_questionnaires, has_sensors = c.fetchone()
+
+            # Same layout as concatenating the questionnaire and sensor frames
+            if has_questionnaires:
+                header = ["type", "record_id", "questionnaire_id", "timestamp"] + keys
+                if has_sensors:
+                    header += ["source_filename", "bpm", "hrv"]
+            elif has_sensors:
+                header = ["type", "record_id", "source_filename", "bpm", "hrv", "timestamp"]
+            else:
+                yield "\n"
+                return
+
+            buf = io.StringIO()
+            writer = csv.DictWriter(buf, header, extrasaction="ignore", lineterminator="\n")
+            writer.writeheader()
+
+            def flush():
+                chunk = buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+                return chunk
+
+            c.execute("""
+                SELECT id, questionnaire_id, responses, timestamp 
+                FROM questionnaires 
+                WHERE user_id=? 
+                ORDER BY timestamp, id
+            """, (user_id,))
+            for n, r in enumerate(c, 1):
+                try:
+                    responses = _json_loads(r['responses'])
+                except ValueError:
+                    logger.warning(f"Skipping malformed questionnaire row {r['id']} in export")
+                    continue
+                writer.writerow({**responses, "type": "questionnaire", "record_id": r['id'],
+                                 "questionnaire_id": r['questionnaire_id'],
+                                 "timestamp": r['timestamp']})
+                if n % batch_size == 0:
+                    yield flush()
+
+            c.execute(_SQL_SENSOR_HISTORY, (user_id,))
+            for n, r in enumerate(c, 1):
+                writer.writerow({"type": "sensor", "record_id": r['id'],
+                                 "source_filename": r['source_filename'], "bpm": r['bpm'],
+                                 "hrv": r['hrv'], "timestamp": r['timestamp']})
+                if n % batch_size == 0:
+                    yield flush()
+
+            yield flush()
+
+    except Exception as e:
+        logger.error(f"Error streaming export for user {user_id}: {e}", exc_info=True)
+        raise
@@ -2,6 +2,8 @@
 from dash import dcc, html
 import dash_bootstrap_components as dbc
 
+# Todos los campos son numéricos: db.save_questionnaire guarda además float() de
+# cada respuesta en '_numeric' (ver db._numeric_responses)
 QUESTIONNAIRES = {
     "general": {
         "title": "Autopercepción general",
@@ -31,6 +33,9 @@ QUESTIONNAIRES = {
 def get_questionnaire_list():
     return [{"id": k, "title": QUESTIONNAIRES[k]["title"]} for k in QUESTIONNAIRES]
 
+# Opciones para el selector de cuestionarios, calculadas una sola vez al importar
+QUESTIONNAIRE_OPTIONS = [{"label": q["title"], "value": q["id"]} for q in get_questionnaire_list()]
+
 def render_questionnaire_form(qid):
     if qid not in QUESTIONNAIRES:
         return html.Div()
@@ -11,6 +11,51 @@ try:
 except Exception:
     SCIPY_AVAILABLE = False
 
+# PyArrow (opcional) parsea el CSV directamente desde los bytes subidos
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    PYARROW_AVAILABLE = True
+except Exception:
+    PYARROW_AVAILABLE = False
+
+# Numba es opcional: compila el bucle de picos del modo sin scipy
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except Exception:
+    NUMBA_AVAILABLE = False
+
+# CuPy (opcional) procesa lotes de señales en GPU
+try:
+    import cupy as cp
+    CUPY_AVAILABLE = True
+except Exception:
+    CUPY_AVAILABLE = False
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _threshold_peaks(sig, min_dist):
+        """Picos sobre mean+std con periodo refractario, en una sola pasada compilada."""
+        n = sig.shape[0]
+        mu = 0.0
+        for i in range(n):
+            mu += sig[i]
+        mu /= n
+        var = 0.0
+        for i in range(n):
+            var += (sig[i] - mu) ** 2
+        thr = mu + np.sqrt(var / n)
+        out = np.empty(n, np.int64)
+        m = 0
+        last = 0
+        for i in range(n):
+            if sig[i] > thr and (m == 0 or i - last > min_dist):
+                out[m] = i
+                m += 1
+                last = i
+        return out[:m]
+
 def parse_csv_contents(contents, filename):
     """
     Recibe contents base64 y filename (como dash dcc.Upload entrega).
@@ -18,6 +63,15 @@ def parse_csv_contents(contents, filename):
     """
     content_type, content_string = contents.split(',')
     decoded = base64.b64decode(content_string)
+    if PYARROW_AVAILABLE:
+        # sin StringIO intermedio; si arrow no puede, seguimos con pandas
+        for delimiter in (',', ';'):
+            try:
+                table = pacsv.read_csv(pa.BufferReader(decoded),
+                                       parse_options=pacsv.ParseOptions(delimiter=delimiter))
+                return table.to_pandas()
+            except Exception:
+                continue
     try:
         s = io.StringIO(decoded.decode('utf-8', errors='ignore'))
         df = pd.read_csv(s)
@@ -31,6 +85,28 @@ def parse_csv_contents(contents, filename):
         except Exception:
             return None
 
+def _select_signal(df, signal_column_guess=None):
+    """Devuelve la columna de señal ECG como array float."""
+    if signal_column_guess and signal_column_guess in df.columns:
+        return df[signal_column_guess].astype(float).values
+    # coger la primera columna numérica
+    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
+    if not numeric_cols:
+        # intentar la primera columna
+        return df.iloc[:, 0].astype(float).values
+    return df[numeric_cols[0]].astype(float).values
+
+def _bpm_hrv_from_peaks(peaks, fs):
+    """A partir de los índices de picos R: (BPM medio, SDNN en ms) o (None, None)."""
+    if len(peaks) < 2:
+        return None, None
+    # tiempos de picos en segundos
+    t_peaks = peaks / float(fs)
+    ibis = np.diff(t_peaks)
+    mean_hr = 60.0 / np.mean(ibis)
+    sdnn = float(np.std(ibis) * 1000.0)  # ms
+    return float(mean_hr), float(sdnn)
+
 def load_ecg_and_compute_bpm(df, signal_column_guess=None, fs=250):
     """
     Entrada: df pandas con columna de señal ECG (o columna única).
@@ -44,17 +120,7 @@ def load_ecg_and_compute_bpm(df, signal_column_guess=None, fs=250):
     if df is None or df.shape[0] < 10:
         return None, None
 
-    # Seleccionar columna de señal
-    if signal_column_guess and signal_column_guess in df.columns:
-        signal = df[signal_column_guess].astype(float).values
-    else:
-        # coger la primera columna numérica
-        numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
-        if not numeric_cols:
-            # intentar la primera columna
-            signal = df.iloc[:, 0].astype(float).values
-        else:
-            signal = df[numeric_cols[0]].astype(float).values
+    signal = _select_signal(df, signal_column_guess)
 
     if SCIPY_AVAILABLE:
         # detrend y normalizar
@@ -62,33 +128,32 @@ def load_ecg_and_compute_bpm(df, signal_column_guess=None, fs=250):
         # detectar picos (ajustable)
         distance = int(0.4 * fs)  # al menos 0.4s entre latidos
         peaks, _ = find_peaks(sig, distance=distance, height=np.std(sig) * 0.5)
-        if len(peaks) < 2:
-            return None, None
-        # tiempos de picos en segundos
-        t_peaks = peaks / float(fs)
-        ibis = np.diff(t_peaks)
-        if len(ibis) == 0:
-            return None, None
-        mean_hr = 60.0 / np.mean(ibis)
-        sdnn = float(np.std(ibis) * 1000.0)  # ms
-        return float(mean_hr), float(sdnn)
+        return _bpm_hrv_from_peaks(peaks, fs)
     else:
         # fallback: aproximación muy simple:
         # calcular "pseudo-BPM" por energía y duración
         length_sec = len(signal) / float(fs)
         if length_sec <= 0:
             return None, None
-        # contar picos simples por umbral
-        thr = np.mean(signal) + np.std(signal)
-        peaks = np.where(signal > thr)[0]
-        # dedupe based on distance (~0.4s)
-        if len(peaks) == 0:
-            return None, None
-        dedup = [peaks[0]]
         min_dist = int(0.4 * fs)
-        for p in peaks[1:]:
-            if p - dedup[-1] > min_dist:
-                dedup.append(p)
+        if NUMBA_AVAILABLE:
+            dedup = _threshold_peaks(np.ascontiguousarray(signal, dtype=np.float64), min_dist)
+            if len(dedup) == 0:
+                return None, None
+        else:
+            # contar picos simples por umbral
+            thr = np.mean(signal) + np.std(signal)
+            peaks = np.where(signal > thr)[0]
+            # dedupe based on distance (~0.4s)
+            if len(peaks) == 0:
+                return None, None
+            dedup = [peaks[0]]
+            # saltar por búsqueda binaria al primer pico fuera del periodo refractario:
+            # una iteración por latido, no por muestra sobre el umbral
+            i = np.searchsorted(peaks, dedup[-1] + min_dist, side='right')
+            while i < len(peaks):
+                dedup.append(peaks[i])
+                i = np.searchsorted(peaks, peaks[i] + min_dist, side='right')
         nbeats = len(dedup)
         bpm = (nbeats / length_sec) * 60.0
         # hrv fallback: std of beat intervals approximated
@@ -98,3 +163,131 @@ def load_ecg_and_compute_bpm(df, signal_column_guess=None, fs=250):
         else:
             sdnn = None
         return float(bpm), sdnn
+
+def _select_by_distance(peaks, heights, distance):
+    """
+    Regla distance de scipy.signal.find_peaks: del pico más alto al más bajo,
+    descarta los picos a menos de distance muestras de uno ya conservado.
+    """
+    keep = np.ones(len(peaks), dtype=bool)
+    for j in np.argsort(heights)[::-1]:
+        if not keep[j]:
+            continue
+        k = j - 1
+        while k >= 0 and peaks[j] - peaks[k] < distance:
+            keep[k] = False
+            k -= 1
+        k = j + 1
+        while k < len(peaks) and peaks[k] - peaks[j] < distance:
+            keep[k] = False
+            k += 1
+    return peaks[keep]
+
+def load_ecg_and_compute_bpm_batch(dfs, signal_column_guess=None, fs=250):
+    """
+    Versión por lotes de load_ecg_and_compute_bpm para muchos ficheros a la vez.
+    Con CuPy (GPU) las señales de igual longitud se apilan en una matriz (N, T):
+    detrend, umbral y máximos locales (con mesetas, sin los extremos, igual que
+    find_peaks) se calculan en el dispositivo y solo se descargan los candidatos;
+    la regla de distancia entre latidos se aplica después sobre ellos en CPU, así
+    que el resultado es el de find_peaks salvo redondeos del detrend.
+    Sin CuPy se procesa cada fichero con load_ecg_and_compute_bpm.
+    Retorna: lista de (bpm, hrv), una por DataFrame.
+    """
+    if not CUPY_AVAILABLE:
+        return [load_ecg_and_compute_bpm(df, signal_column_guess, fs) for df in dfs]
+
+    results = [(None, None)] * len(dfs)
+    # agrupar por longitud para poder apilar
+    groups = {}
+    for i, df in enumerate(dfs):
+        if df is None or df.shape[0] < 10:
+            continue
+        groups.setdefault(df.shape[0], []).append((i, _select_signal(df, signal_column_guess)))
+
+    distance = int(0.4 * fs)  # al menos 0.4s entre latidos
+    for length, items in groups.items():
+        sig = cp.asarray(np.stack([signal for _, signal in items]))
+        # detrend lineal por fila (equivalente a scipy.signal.detrend)
+        t = cp.arange(length, dtype=sig.dtype) - (length - 1) / 2.0
+        sig = sig - sig.mean(axis=1, keepdims=True)
+        slope = (sig * t).sum(axis=1, keepdims=True) / (t * t).sum()
+        sig = sig - slope * t
+        thr = sig.std(axis=1) * 0.5
+        # máximos locales como find_peaks: tramos de valores iguales con un vecino
+        # menor a cada lado (pico en el centro del tramo), sin tocar los extremos
+        flat = sig.ravel()
+        col = cp.arange(flat.size) % length
+        new_run = cp.ones(flat.size, dtype=bool)
+        new_run[1:] = flat[1:] != flat[:-1]
+        new_run[col == 0] = True  # los tramos no cruzan de una fila a otra
+        starts = cp.flatnonzero(new_run)
+        ends = cp.concatenate([starts[1:] - 1, cp.asarray([flat.size - 1])])
+        inner = (col[starts] > 0) & (col[ends] < length - 1)
+        starts, ends = starts[inner], ends[inner]
+        values = flat[starts]
+        is_peak = ((flat[starts - 1] < values) & (flat[ends + 1] < values)
+                   & (values >= thr[starts // length]))
+        peaks = cp.asnumpy((starts[is_peak] + ends[is_peak]) // 2)
+        heights = cp.asnumpy(values[is_peak])
+        # los candidatos salen ordenados por fila: cortar por fila con searchsorted
+        bounds = np.searchsorted(peaks, np.arange(len(items) + 1) * length)
+        for r, (i, _) in enumerate(items):
+            lo, hi = bounds[r], bounds[r + 1]
+            row_peaks = _select_by_distance(peaks[lo:hi] - r * length, heights[lo:hi], distance)
+            results[i] = _bpm_hrv_from_peaks(row_peaks, fs)
+    return results
+
+def process_uploaded_files(contents_list, filenames, fs=250):
+    """
+    Procesa un lote de ficheros subidos (contents base64 + nombres, como dcc.Upload con multiple=True).
+    Pensado para ejecutarse fuera del hilo de la petición (callback en background).
+    Retorna: lista de (filename, bpm, hrv); bpm/hrv son None si el fichero no se pudo analizar.
+    """
+    results = []
+    for contents, filename in zip(contents_list or [], filenames or []):
+        df = parse_csv_contents(contents, filename)
+        bpm, hrv = load_ecg_and_compute_bpm(df, fs=fs)
+        results.append((filename, bpm, hrv))
+    return results
+
+def downsample_lttb(x, y, n_out=2000):
+    """
+    Reduce la serie (x, y) a n_out puntos con Largest-Triangle-Three-Buckets,
+    conservando la forma visual de la curva para no enviar todos los puntos al navegador.
+    x debe ser creciente (numérico o datetime64); y numérico y sin NaN.
+    Retorna: (x, y) como arrays de NumPy. Si la serie ya es corta se devuelve entera.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return x, y
+
+    # trabajar en float (los datetime64 pasan a enteros)
+    if np.issubdtype(x.dtype, np.datetime64):
+        xf = x.astype('datetime64[ns]').astype(np.int64).astype(float)
+    else:
+        xf = x.astype(float)
+    yf = y.astype(float)
+
+    every = (n - 2) / float(n_out - 2)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0] = 0
+    a = 0
+    for i in range(n_out - 2):
+        # punto medio del siguiente bucket
+        next_start = int(np.floor((i + 1) * every)) + 1
+        next_end = min(int(np.floor((i + 2) * every)) + 1, n)
+        avg_x = xf[next_start:next_end].mean()
+        avg_y = yf[next_start:next_end].mean()
+
+        # punto del bucket actual que forma el triángulo de mayor área
+        start = int(np.floor(i * every)) + 1
+        end = int(np.floor((i + 1) * every)) + 1
+        area = np.abs((xf[a] - avg_x) * (yf[start:end] - yf[a])
+                      - (xf[a] - xf[start:end]) * (avg_y - yf[a]))
+        a = start + int(np.argmax(area))
+        idx[i + 1] = a
+    idx[-1] = n - 1
+    return x[idx], y[idx]
@@ -0,0 +1,59 @@
+import os
+import signal
+import tempfile
+import unittest
+
+import db
+
+
+def setUpModule():
+    global _tmpdir
+    _tmpdir = tempfile.TemporaryDirectory()
+    # Before any pooled connection is opened, so every thread uses the test database
+    db.DB_PATH = os.path.join(_tmpdir.name, "test.db")
+    db.init_db()
+
+
+def tearDownModule():
+    db.flush_sensor_writes()
+    db._close_pool()
+    _tmpdir.cleanup()
+
+
+class SensorWriterTest(unittest.TestCase):
+
+    def test_queued_readings_visible_after_flush(self):
+        for bpm in (60, 61, 62):
+            self.assertTrue(db.save_sensor_data(1, f"{bpm}.csv", bpm, 50))
+        rows = db.get_sensor_history(1)
+        self.assertEqual([r["bpm"] for r in rows], [60.0, 61.0, 62.0])
+
+    def test_sync_batch_keeps_call_order(self):
+        db.save_sensor_data(2, "f.csv", 60, 50)
+        db.save_sensor_data_many(2, [("a.csv", 61, 51), ("b.csv", 62, 52)])
+        rows = sorted(db.get_sensor_history(2), key=lambda r: r["id"])
+        self.assertEqual([r["source_filename"] for r in rows], ["f.csv", "a.csv", "b.csv"])
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires os.fork")
+    def test_forked_child_gets_fresh_writer(self):
+        db.save_sensor_data(3, "parent.csv", 60, 50)
+        db.flush_sensor_writes()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.alarm(10)  # a hang in the child fails the test instead of blocking it
+                ok = db._writer_thread is None
+                db.save_sensor_data(3, "child.csv", 61, 51)
+                names = [r["source_filename"] for r in db.get_sensor_history(3)]
+                code = 0 if ok and names == ["parent.csv", "child.csv"] else 1
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        names = [r["source_filename"] for r in db.get_sensor_history(3)]
+        self.assertEqual(names, ["parent.csv", "child.csv"])
+
+
+if __name__ == "__main__":
+    unittest.main()